@@ -1,13 +1,31 @@
+import base64
+from contextlib import asynccontextmanager
+import os
+
+import anyio
+import numpy as np
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 import uvicorn
 import timeit
 
 from src.schemas import MandelRequestSchema
 from src.mandelbrot import Mandelbrot
+from src.images import MandelImage
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The renders are CPU bound, at most one per core runs at the same time in the worker threads
+    app.state.render_limiter = anyio.CapacityLimiter(os.cpu_count() or 1)
+    # A tiny render at startup starts the threading layer of the kernel, so the first request
+    # does not pay for it
+    Mandelbrot().main_loop(np.linspace(-2, 1, 8), np.linspace(1, -1, 8), 8, 2)
+    yield
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 origins = ["http://localhost:9000"]
 
 app.add_middleware(
@@ -42,24 +60,85 @@ def test_arr():
     }
 
 
+def encode_array(array, dtype) -> dict:
+    """
+    Encodes an array as base64 raw bytes, with the dtype and shape needed to decode it
+    (e.g. np.frombuffer(base64.b64decode(data), dtype).reshape(shape)).
+    """
+    array = np.ascontiguousarray(array, dtype=dtype)
+    return {
+        "data": base64.b64encode(array.tobytes()).decode(),
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+    }
+
+
+def render_mandelbrot(request_data: MandelRequestSchema) -> ORJSONResponse:
+    """
+    Calculates the Mandelbrot data for the request and serializes the response.
+    Runs in a worker thread, the serialization of large grids is done there as well
+    so it does not block the event loop.
+    """
+    mdlbrt = Mandelbrot()
+    mdl_data = mdlbrt.mandel_data_from_request(request_data)
+    if request_data.is_base64:
+        if request_data.is_canvas:
+            color = encode_array(mdl_data.color_data, np.uint8)
+        else:
+            color = {
+                key: encode_array(value, np.uint8)
+                for key, value in mdl_data.color_data.items()
+            }
+        return ORJSONResponse(
+            {
+                "count_grid": encode_array(
+                    mdl_data.count_grid, mdl_data.count_grid.dtype
+                ),
+                "complex_grid": {
+                    "x_line": encode_array(mdl_data.x_line, np.float64),
+                    "y_line": encode_array(mdl_data.y_line, np.float64),
+                },
+                "color": color,
+            }
+        )
+
+    complex_grid = {
+        "x_line": mdl_data.x_line,
+        "y_line": mdl_data.y_line,
+    }
+    # orjson serializes the numpy arrays directly, no intermediate Python lists are built
+    return ORJSONResponse(
+        {
+            "count_grid": mdl_data.count_grid,
+            "complex_grid": complex_grid,
+            "color": mdl_data.color_data,
+        }
+    )
+
+
 @app.post("/get_mandelbrot")
-def get_mandelbrot(request_data: MandelRequestSchema):
+async def get_mandelbrot(request_data: MandelRequestSchema):
     start_time = timeit.default_timer()
 
     try:
-        mdlbrt = Mandelbrot()
-        count_grid, x_line, y_line, color_data = mdlbrt.main_loop(request_data)
-        count_grid_list = count_grid.tolist()
-        complex_grid = {
-            "x_line": x_line.tolist(),
-            "y_line": y_line.tolist(),
-        }
+        response = await anyio.to_thread.run_sync(
+            render_mandelbrot, request_data, limiter=app.state.render_limiter
+        )
         end_time = timeit.default_timer()
         print(f"Time taken: {end_time - start_time}")
-        return {
-            "count_grid": count_grid_list,
-            "complex_grid": complex_grid,
-            "color": color_data,
-        }
+        return response
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/get_mandelbrot_image")
+async def get_mandelbrot_image(request_data: MandelRequestSchema):
+    try:
+        png_bytes = await anyio.to_thread.run_sync(
+            MandelImage().image_bytes_request,
+            request_data,
+            limiter=app.state.render_limiter,
+        )
+        return Response(content=png_bytes, media_type="image/png")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
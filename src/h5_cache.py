@@ -1,5 +1,6 @@
 import os
 import timeit
+from contextlib import contextmanager
 
 import numpy as np
 import h5py
@@ -21,12 +22,51 @@ class H5Cache:
 
         self.create_file()  # Create the folder and file if it doesn't exist
 
+        self._h5 = (
+            None  # The shared h5py.File handle while the cache is open (see __enter__)
+        )
+        self._open_count = 0  # Nesting depth of the with blocks using the shared handle
+
         self.depth = (
             0  # This is the depth of the mandelbrot set used in create_initial_cache()
         )
         self.level_granularity = 2  # How many times to split the x and y lines
         self.base_name = "0"  # The base name of each level
 
+    def __enter__(self):
+        """
+        Opens the HDF5 file once and shares the handle with every read and write done inside the
+        with block, instead of opening (and flushing) the file on every call.
+        The newest file format is used for faster metadata and a 64 MB chunk cache absorbs the
+        compressed chunk writes. Nested with blocks reuse the same handle.
+        """
+        if self._open_count == 0:
+            self._h5 = h5py.File(
+                self.file_path, "a", libver="latest", rdcc_nbytes=64 * 1024 * 1024
+            )
+        self._open_count += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._open_count -= 1
+        if self._open_count == 0:
+            self._h5.close()
+            self._h5 = None
+
+    @contextmanager
+    def _get_file(self, mode: str):
+        """
+        Yields the shared handle when the cache is open, otherwise opens the file for this call only.
+
+        Args:
+            mode (str): The h5py mode used when the file has to be opened.
+        """
+        if self._h5 is not None:
+            yield self._h5
+        else:
+            with h5py.File(self.file_path, mode) as f:
+                yield f
+
     def create_cache(self, data: MandelData):
         """
         Creates a cache in an HDF5 file for the given MandelData object.
@@ -37,41 +77,61 @@ class H5Cache:
         Returns:
             None
         """
-        with h5py.File(self.file_path, "r+") as f:
+        with self._get_file("r+") as f:
             level_group = f.create_group(data.level)
             level_group.create_dataset(
-                "count_grid", data=data.count_grid.astype(np.uint8)
+                "count_grid",
+                data=data.count_grid,  # Already uint8 (or uint16 when max_iter > 255)
+                **self.compression_options(data.count_grid.shape),
             )
             level_group.create_dataset("x_line", data=data.x_line)
             level_group.create_dataset("y_line", data=data.y_line)
-            level_group.create_dataset("red", data=data.color_data["red"])
-            level_group.create_dataset("green", data=data.color_data["green"])
-            level_group.create_dataset("blue", data=data.color_data["blue"])
+            # The colors are not stored, they are regenerated from the counts in read_cache
+            level_group.attrs["max_iter"] = data.max_iter
 
-    def read_cache(self, level: str):
+    def compression_options(self, shape: tuple) -> dict:
+        """
+        Returns the create_dataset options used for the large datasets of a level.
+        The data is chunked in tiles of at most 256x256 and compressed with LZF (fast) after
+        a byte shuffle, the count grids have low entropy and compress several times.
+
+        Args:
+            shape (tuple): The shape of the dataset.
+
+        Returns:
+            dict: The keyword arguments for create_dataset.
+        """
+        chunks = tuple(min(256, size) for size in shape[:2]) + tuple(shape[2:])
+        return {"chunks": chunks, "compression": "lzf", "shuffle": True}
+
+    def read_cache(self, level: str, with_colors=True):
         """
         Reads the cache data for the specified level.
         Args:
             level (str): The level of the cache data to read.
+            with_colors (bool, optional): Regenerates the colors from the counts, the refinement of
+                                          the levels only needs the lines and counts. Defaults to True.
         Returns:
             MandelData: An instance of the MandelData class containing the cache data.
 
         """
         print(level)
-        with h5py.File(self.file_path, "r") as f:
+        with self._get_file("r") as f:
             level_group = f[level]
             count_grid = level_group["count_grid"][:]
             x_line = level_group["x_line"][:]
             y_line = level_group["y_line"][:]
-            red = level_group["red"][:]
-            green = level_group["green"][:]
-            blue = level_group["blue"][:]
+            max_iter = int(level_group.attrs["max_iter"])
+            color_data = None
+            if with_colors:
+                color_data = Mandelbrot().colorize(count_grid, max_iter)
             return MandelData(
                 count_grid=count_grid,
                 x_line=x_line,
                 y_line=y_line,
-                color_data={"red": red, "green": green, "blue": blue},
+                color_data=color_data,
                 level=level,
+                max_iter=max_iter,
             )
 
     def create_initial_cache(
@@ -98,22 +158,31 @@ class H5Cache:
         # Create the initial level and the base name for it
         self.base_name = len(str(level_granularity**2 - 1)) * str(0)
 
-        # Create the initial level
-        mdlbrt = Mandelbrot()
-        mdl_data = mdlbrt.mandel_data_from_lines(starting_linespace)
-        mdl_data.level = str(self.base_name)
-        self.create_cache(mdl_data)
+        with self:  # One file handle for the whole tree
+            # Create the initial level
+            mdlbrt = Mandelbrot()
+            # Only the counts are stored, the colors are regenerated when a level is read
+            mdl_data = mdlbrt.main_loop(
+                starting_linespace.x_line,
+                starting_linespace.y_line,
+                starting_linespace.max_iter,
+                starting_linespace.iteration_limit,
+            )
+            mdl_data.level = str(self.base_name)
+            self.create_cache(mdl_data)
 
-        max_level = self.base_name * self.depth
+            max_level = self.base_name * self.depth
 
-        current_level = self.base_name
-        while len(current_level) <= len(max_level):
+            current_level = self.base_name
+            while len(current_level) <= len(max_level):
 
-            for parrent_item in self.get_keys_at_level(current_level):
-                parrent_mdl_data = self.read_cache(str(parrent_item))
-                self.generate_next_level(parrent_mdl_data)
+                for parrent_item in self.get_keys_at_level(current_level):
+                    parrent_mdl_data = self.read_cache(
+                        str(parrent_item), with_colors=False
+                    )
+                    self.generate_next_level(parrent_mdl_data)
 
-            current_level += self.base_name
+                current_level += self.base_name
 
     def generate_next_level(self, parrent_mdl_data: MandelData) -> None:
         """
@@ -139,20 +208,46 @@ class H5Cache:
         iter_box = np.arange(self.level_granularity**2).reshape(
             self.level_granularity, -1
         )  # Creates a 2D array of the iteration box
-        mdlbrt = Mandelbrot()
-        for box_row, y_item in zip(
-            iter_box, np.array_split(next_y_line, self.level_granularity)
-        ):
-            for box_item, x_item in zip(
-                box_row, np.array_split(next_x_line, self.level_granularity)
-            ):
-                print(box_item, "x:", x_item[0], "y:", y_item[0])
-                mdl_line_space = MandelLineSpaceSchema(
-                    x_line=x_item, y_line=y_item[::-1]
-                )
-                mdl_data = mdlbrt.mandel_data_from_lines(mdl_line_space)
+
+        # The whole refined grid is calculated at once (y from bottom to top like the parent),
+        # the children are then sliced out of it instead of being calculated one by one
+        # Only the counts are needed, the colors are regenerated when a level is read
+        line_space = MandelLineSpaceSchema(x_line=next_x_line, y_line=next_y_line[::-1])
+        full_data = Mandelbrot().main_loop(
+            line_space.x_line,
+            line_space.y_line,
+            line_space.max_iter,
+            line_space.iteration_limit,
+        )
+        # Each child is a view of the refined lines and grid, the slices are computed once
+        child_width = len(next_x_line) // self.level_granularity
+        child_height = len(next_y_line) // self.level_granularity
+        col_slices = [
+            slice(k * child_width, (k + 1) * child_width)
+            for k in range(self.level_granularity)
+        ]
+        # The box rows go from top to bottom, the rows of the grid from bottom to top
+        row_slices = [
+            slice(
+                (self.level_granularity - 1 - k) * child_height,
+                (self.level_granularity - k) * child_height,
+            )
+            for k in range(self.level_granularity)
+        ]
+        for box_row, rows in zip(iter_box, row_slices):
+            y_item = line_space.y_line[rows]
+            for box_item, cols in zip(box_row, col_slices):
+                x_item = next_x_line[cols]
+                print(box_item, "x:", x_item[0], "y:", y_item[-1])
                 formated_name = str(box_item).zfill(len(self.base_name))
-                mdl_data.level = f"{parrent_name}{formated_name}"
+                mdl_data = MandelData(
+                    count_grid=full_data.count_grid[rows, cols],
+                    x_line=x_item,
+                    y_line=y_item,
+                    color_data=None,
+                    level=f"{parrent_name}{formated_name}",
+                    max_iter=full_data.max_iter,
+                )
                 self.create_cache(mdl_data)
 
     def get_keys_at_level(self, level_depth: int):
@@ -166,7 +261,7 @@ class H5Cache:
             list: A list of keys at the specified level depth.
         """
         required_level_len = len(level_depth)
-        with h5py.File(self.file_path, "r") as f:
+        with self._get_file("r") as f:
             keys_l = list(f.keys())
             return [key for key in keys_l if len(key) == required_level_len]
 
@@ -177,7 +272,7 @@ class H5Cache:
         """
         os.makedirs(self.data_folder, exist_ok=True)
         if not os.path.exists(self.file_path):
-            with h5py.File(self.file_path, "w") as f:
+            with h5py.File(self.file_path, "w", libver="latest") as f:
                 pass
 
 
@@ -1,16 +1,55 @@
+from io import BytesIO
+
 import numpy as np
-from PIL import Image
 from src.schemas import MandelData, MandelRequestSchema
+from src.mandelbrot import Mandelbrot
+
 
 class MandelImage:
     def __init__(self):
         pass
-    
+
     def generate_image_request(self, mdl_data: MandelRequestSchema):
-        _, _, _, color_data = self.main_loop(mdl_data)
-        red = color_data["red"]
-        green = color_data["green"]
-        blue = color_data["blue"]
-        color_stack = np.stack([red, green, blue], axis=2)
-        img = Image.fromarray(color_stack.astype("uint8"))
-        return img
\ No newline at end of file
+        """
+        Generates a PIL image of the Mandelbrot set for the given request.
+
+        Args:
+            mdl_data (MandelRequestSchema): The request describing the view to render.
+
+        Returns:
+            Image: The RGB image.
+        """
+        # PIL is only loaded by the first image request, the JSON endpoints never need it
+        from PIL import Image
+
+        mdlbrt = Mandelbrot()
+        count_grid = mdlbrt.count_data_from_request(mdl_data).count_grid
+        height = count_grid.shape[0]
+        width = count_grid.shape[1] * mdl_data.pixel_per_point
+
+        # The colormap gather writes the packed RGB pixels straight into the image buffer, strip
+        # by strip, repeating the 1 byte counts is cheaper than repeating the 3 byte colors
+        rgb = np.empty((height, width, 3), dtype=np.uint8)
+        lut, indices = mdlbrt.color_table(count_grid, mdl_data.max_iter)
+        mdlbrt.gather_colors(lut, indices, mdl_data.pixel_per_point, rgb)
+        img = Image.frombuffer("RGB", (width, height), rgb, "raw", "RGB", 0, 1)
+        return img
+
+    def image_bytes_request(self, mdl_data: MandelRequestSchema, image_format="PNG"):
+        """
+        Generates the image for the given request and encodes it.
+        PNGs use the fastest zlib level, the Mandelbrot images still compress well with it.
+
+        Args:
+            mdl_data (MandelRequestSchema): The request describing the view to render.
+            image_format (str, optional): The format passed to PIL. Defaults to "PNG".
+
+        Returns:
+            bytes: The encoded image.
+        """
+        save_options = {"compress_level": 1} if image_format == "PNG" else {}
+        buffer = BytesIO()
+        self.generate_image_request(mdl_data).save(
+            buffer, format=image_format, **save_options
+        )
+        return buffer.getvalue()
@@ -0,0 +1,99 @@
+import numpy as np
+from numba import cuda
+
+from src.mandel_kernel import PERIOD_CHECK
+
+# (x, y) threads per block, x runs along a row so the writes to out are coalesced
+THREADS_PER_BLOCK = (16, 16)
+
+
+@cuda.jit(device=True)
+def _in_main_bulbs(x, y):
+    """
+    Device version of `in_main_bulbs`, True inside the main cardioid or the period-2 bulb.
+    """
+    x_shift = x - 0.25
+    y_sq = y * y
+    q = x_shift * x_shift + y_sq
+    if q * (q + x_shift) < 0.25 * y_sq:
+        return True
+    return (x + 1.0) * (x + 1.0) + y_sq < 0.0625
+
+
+@cuda.jit(fastmath=True)
+def _mandel_cuda_kernel(cr, ci, max_iter, limit_sq, out):
+    """
+    Escape-time kernel with one CUDA thread per point, same counts as `mandel_kernel`.
+    """
+    j, i = cuda.grid(2)
+    if i < out.shape[0] and j < out.shape[1]:
+        cx = cr[j]
+        cy = ci[i]
+        if limit_sq >= 4.0 and _in_main_bulbs(cx, cy):
+            out[i, j] = max_iter
+            return
+        # Start from z1 = c, this keeps every value in the dtype of the grid (no float64 literals)
+        zr = cx
+        zi = cy
+        zr_sq = cx * cx
+        zi_sq = cy * cy
+        # Checkpoint of the periodicity check, moved at doubling intervals (Brent)
+        saved_zr = zr
+        saved_zi = zi
+        save_at = PERIOD_CHECK
+        k = 0
+        while k < max_iter:
+            if zr_sq + zi_sq > limit_sq:
+                break
+            if k % PERIOD_CHECK == 0 and k > 0:
+                if zr == saved_zr and zi == saved_zi:
+                    # Back at the checkpoint, the point cycles forever and never escapes
+                    k = max_iter
+                    break
+                if k == save_at:
+                    saved_zr = zr
+                    saved_zi = zi
+                    save_at += save_at
+            k += 1
+            zi = (zr + zr) * zi + cy
+            zr = zr_sq - zi_sq + cx
+            zr_sq = zr * zr
+            zi_sq = zi * zi
+        out[i, j] = k
+
+
+def cuda_available() -> bool:
+    """
+    Returns True when a CUDA device can be used.
+    """
+    return cuda.is_available()
+
+
+def mandel_cuda(cr: np.array, ci: np.array, max_iter: int, limit_sq, out: np.array):
+    """
+    Runs the escape-time kernel on the GPU and copies the counts back into out.
+
+    Args:
+        cr (np.array): The real parts of the grid (the x_line).
+        ci (np.array): The imaginary parts of the grid (the y_line), same dtype as cr.
+        max_iter (int): Maximum number of iterations.
+        limit_sq (float): The squared escape limit (iteration_limit**2), same dtype as cr.
+        out (np.array): 2D array of shape (len(ci), len(cr)) where the counts are written.
+    """
+    stream = cuda.stream()
+    d_cr = cuda.to_device(cr, stream=stream)
+    d_ci = cuda.to_device(ci, stream=stream)
+    d_out = cuda.device_array(out.shape, dtype=out.dtype, stream=stream)
+
+    blocks_per_grid = (
+        (out.shape[1] + THREADS_PER_BLOCK[0] - 1) // THREADS_PER_BLOCK[0],
+        (out.shape[0] + THREADS_PER_BLOCK[1] - 1) // THREADS_PER_BLOCK[1],
+    )
+    _mandel_cuda_kernel[blocks_per_grid, THREADS_PER_BLOCK, stream](
+        d_cr, d_ci, max_iter, limit_sq, d_out
+    )
+
+    # Page-locked host memory for a direct DMA copy of the counts
+    with cuda.pinned(out):
+        d_out.copy_to_host(out, stream=stream)
+        stream.synchronize()
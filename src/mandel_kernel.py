@@ -0,0 +1,159 @@
+import threading
+
+import numpy as np
+from numba import njit, prange, threading_layer
+
+# Number of points of a row iterated in lockstep, the inner loop over the lanes is
+# what LLVM vectorizes into packed AVX2/AVX-512 multiplies, FMAs and compares
+LANES = 32
+# The grid is split in TILE x TILE blocks that are distributed over the cores (multiple of LANES)
+TILE = 64
+# Every PERIOD_CHECK iterations the lanes are compared to their checkpoint (periodicity check)
+PERIOD_CHECK = 16
+
+
+@njit(inline="always")
+def in_main_bulbs(x, y) -> bool:
+    """
+    Closed-form test for the main cardioid and the period-2 bulb, the points inside them never
+    escape (|z| stays <= 2), so they can be set to max_iter without iterating.
+    """
+    x_shift = x - 0.25
+    y_sq = y * y
+    q = x_shift * x_shift + y_sq
+    if q * (q + x_shift) < 0.25 * y_sq:  # Main cardioid
+        return True
+    return (x + 1.0) * (x + 1.0) + y_sq < 0.0625  # Period-2 bulb
+
+
+# Every combination main_loop can call the kernel with: float32/float64 contiguous lines,
+# int64 max_iter, the squared limit in the float type and the counts of `count_dtype`
+KERNEL_SIGNATURES = [
+    f"void({float_type}[::1], {float_type}[::1], i8, {float_type}, {count_type}[:, ::1])"
+    for float_type in ("f4", "f8")
+    for count_type in ("u1", "u2", "u4", "u8")
+]
+
+
+# With explicit signatures every version is compiled (or loaded from the on-disk cache) at import
+@njit(
+    KERNEL_SIGNATURES,
+    parallel=True,
+    fastmath=True,
+    boundscheck=False,
+    cache=True,
+    nogil=True,
+)
+def mandel_kernel(cr, ci, max_iter, limit_sq, out):
+    """
+    Escape-time kernel compiled with Numba, it releases the GIL so requests can run it from worker
+    threads at the same time (see `kernel_lock`). The grid is split in TILE x TILE tiles distributed over the
+    available cores with prange, so the cheap (escaping) and expensive (interior) regions are balanced.
+    Inside a tile each row is processed in blocks of LANES points iterated together until every point
+    of the block escaped. When the escape limit is at least 2 the points of the main cardioid and the
+    period-2 bulb are set to max_iter up front (`in_main_bulbs`), and every PERIOD_CHECK iterations the
+    points that came back to their checkpoint (they cycle forever) are set to max_iter as well.
+
+    Args:
+        cr (np.array): The real parts of the grid (the x_line), float32 or float64.
+        ci (np.array): The imaginary parts of the grid (the y_line), same dtype as cr.
+        max_iter (int): Maximum number of iterations.
+        limit_sq (float): The squared escape limit (iteration_limit**2), same dtype as cr.
+        out (np.array): 2D unsigned integer array of shape (len(ci), len(cr)) where the counts are written.
+    """
+    height, width = out.shape
+    skip_bulbs = limit_sq >= 4.0  # Interior points only stay below limits of at least 2
+    n_tiles_x = (width + TILE - 1) // TILE
+    n_tiles = ((height + TILE - 1) // TILE) * n_tiles_x
+    for tile in prange(n_tiles):
+        row_start = (tile // n_tiles_x) * TILE
+        col_start = (tile % n_tiles_x) * TILE
+        row_end = min(row_start + TILE, height)
+        col_end = min(col_start + TILE, width)
+        # The lanes use the dtype of the grid, so float32 grids are iterated in float32
+        cx = np.empty(LANES, dtype=cr.dtype)
+        zr = np.empty(LANES, dtype=cr.dtype)
+        zi = np.empty(LANES, dtype=cr.dtype)
+        zr_sq = np.empty(LANES, dtype=cr.dtype)
+        zi_sq = np.empty(LANES, dtype=cr.dtype)
+        counts = np.empty(LANES, dtype=np.int64)
+        # Checkpoints of the periodicity check
+        saved_zr = np.empty(LANES, dtype=cr.dtype)
+        saved_zi = np.empty(LANES, dtype=cr.dtype)
+        for i in range(row_start, row_end):
+            cy = ci[i]
+            for j0 in range(col_start, col_end, LANES):
+                n = min(LANES, col_end - j0)
+                for lane in range(LANES):
+                    # Lanes past the end of the tile repeat its last point
+                    cx[lane] = cr[j0 + min(lane, n - 1)]
+                    zr[lane] = 0.0
+                    zi[lane] = 0.0
+                    zr_sq[lane] = 0.0
+                    zi_sq[lane] = 0.0
+                    saved_zr[lane] = 0.0
+                    saved_zi[lane] = 0.0
+                    counts[lane] = 0
+                    if skip_bulbs and in_main_bulbs(cx[lane], cy):
+                        counts[lane] = max_iter  # Never active in the loop below
+
+                save_at = PERIOD_CHECK
+                for k in range(max_iter):
+                    if k % PERIOD_CHECK == 0 and k > 0:
+                        # A lane back at its checkpoint repeats the same cycle forever, it can
+                        # never escape so it gets max_iter right away
+                        for lane in range(LANES):
+                            if (
+                                counts[lane] == k
+                                and zr[lane] == saved_zr[lane]
+                                and zi[lane] == saved_zi[lane]
+                            ):
+                                counts[lane] = max_iter
+                        if k == save_at:
+                            # The checkpoints move at doubling intervals (Brent), so cycles of
+                            # any period are eventually found
+                            for lane in range(LANES):
+                                saved_zr[lane] = zr[lane]
+                                saved_zi[lane] = zi[lane]
+                            save_at += save_at
+                    n_active = 0
+                    for lane in range(LANES):
+                        # 2 * zr is written as zr + zr so no float64 literal promotes float32 lanes
+                        new_zi = (zr[lane] + zr[lane]) * zi[lane] + cy
+                        new_zr = zr_sq[lane] - zi_sq[lane] + cx[lane]
+                        new_zr_sq = new_zr * new_zr
+                        new_zi_sq = new_zi * new_zi
+                        # A lane is still active only if it did not escape in any previous iteration
+                        inside = new_zr_sq + new_zi_sq <= limit_sq and counts[lane] == k
+                        # Escaped lanes are frozen, so their values never overflow
+                        if inside:
+                            zr[lane] = new_zr
+                            zi[lane] = new_zi
+                            zr_sq[lane] = new_zr_sq
+                            zi_sq[lane] = new_zi_sq
+                            counts[lane] += 1
+                        n_active += inside
+                    if n_active == 0:  # Every lane of the block escaped
+                        break
+
+                for lane in range(n):
+                    out[i, j0 + lane] = counts[lane]
+
+
+@njit("c16[::1](c16, i8)", cache=True)
+def mandel_series(c, iterations):
+    """
+    Compiled recurrence behind `Mandelbrot.generate_series_c`, returns z_1 ... z_iterations for c.
+    """
+    series = np.empty(iterations, dtype=np.complex128)
+    zn = 0j
+    for k in range(iterations):
+        zn = zn * zn + c
+        series[k] = zn
+    return series
+
+
+# The workqueue threading layer (used when neither tbb nor OpenMP is installed) aborts when two
+# threads launch parallel kernels at the same time, callers then have to hold kernel_lock
+KERNEL_THREADSAFE = threading_layer() != "workqueue"
+kernel_lock = threading.Lock()
@@ -1,5 +1,8 @@
+from dataclasses import replace
+from functools import lru_cache
+import threading
+
 import numpy as np
-from PIL import Image
 from src.schemas import (
     MandelData,
     MandelLineSpaceSchema,
@@ -10,35 +13,188 @@ from src.schemas import (
 
 import timeit
 
+try:
+    from src.mandel_kernel import (
+        KERNEL_THREADSAFE,
+        kernel_lock,
+        mandel_kernel,
+        mandel_series,
+    )
+except ImportError:  # numba is optional, main_loop falls back to the NumPy loop
+    mandel_kernel = None
+    mandel_series = None
+
+try:
+    from src.mandel_cuda import cuda_available, mandel_cuda
+except ImportError:  # numba (with its CUDA target) is optional
+    mandel_cuda = None
+
+# Grids with more points than this are sent to the GPU when a CUDA device is available,
+# below it the transfers and the launch cost more than the CPU kernel
+CUDA_MIN_POINTS = 1_000_000
+
+# float32 is used while the grid spacing is at least this many float32 steps (ulps) of the
+# largest coordinate, below that (deep zooms) the rounding visibly changes the counts
+FLOAT32_MIN_ULPS = 1e4
+
+# The NumPy loop removes the escaped points from its arrays once they are 1 / COMPACT_FRACTION
+# of the points still iterated, compacting after every escape costs more than iterating them
+COMPACT_FRACTION = 4
+
+# Every PERIOD_CHECK iterations the NumPy loop compares the points to their checkpoint, the
+# points back at it cycle forever and keep max_iter (same check as in src.mandel_kernel)
+PERIOD_CHECK = 16
+
+# The NumPy loop keeps its scratch buffers between calls (per thread) up to this many points,
+# allocating buffers that large for every request costs more in page faults than the iterations
+SCRATCH_MAX_POINTS = 1_000_000
+
+# Number of requests whose counts are kept (the panning clients request the same frames again),
+# only count grids up to REQUEST_CACHE_MAX_BYTES are cached (whatever their dtype) so the cache
+# holds at most 32 * 4 MiB = 128 MiB, the larger grids are freed after their response
+REQUEST_CACHE_SIZE = 32
+REQUEST_CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+_scratch = threading.local()
+
+# The colormap is only tabulated (and cached) for max_iter below this many counts, max_iter comes
+# from the request and a table of every count up to it would make the memory grow with it
+COLOR_LUT_MAX_ROWS = 65536
+
+# The colors are gathered in strips of rows of about this many bytes, so the upsampled counts
+# and the pixels written from them stay in the L2 cache instead of going through the RAM twice
+COLOR_STRIP_BYTES = 256 * 1024
+
+
+def _count_colors(counts: np.array, max_iter: int) -> np.array:
+    """
+    The colormap of `Mandelbrot.colorize`, returns the uint8 RGB color of each count.
+    """
+    color_max = 255
+    # In float64 like the int64 counts of a table, cos/sin of uint8 counts would be float16
+    counts = counts.astype(np.float64)
+    colors = np.empty(counts.shape + (3,), dtype=np.uint8)
+    colors[..., 0] = counts / max_iter * color_max
+    colors[..., 1] = (np.cos(counts) + 1) / 2 * color_max
+    colors[..., 2] = (np.sin(counts) + 1) / 2 * color_max
+    return colors
+
+
+@lru_cache(maxsize=32)
+def _color_lut(max_iter: int) -> np.array:
+    """
+    Cached table behind `Mandelbrot.color_lut`, read-only as it is shared between calls.
+    """
+    lut = _count_colors(np.arange(max_iter + 1), max_iter)
+    lut.flags.writeable = False
+    return lut
+
+
+@lru_cache(maxsize=1024)
+def _series_c(c: complex, iterations: int) -> np.array:
+    """
+    Cached series behind `Mandelbrot.generate_series_c`, read-only as it is shared between calls.
+    """
+    if mandel_series is not None:
+        series = mandel_series(c, iterations)
+    else:
+        series = np.empty(iterations, dtype=np.complex128)
+        zn = 0j
+        for k in range(iterations):
+            zn = zn * zn + c
+            series[k] = zn
+    series.flags.writeable = False
+    return series
+
+
+def _request_grid(mdl_data: MandelRequestSchema) -> MandelData:
+    """
+    Calculates the counts of a request, see `Mandelbrot.count_data_from_request`.
+    """
+    mdlbrt = Mandelbrot()
+    x_min, x_max, y_min, y_max = mdlbrt.xlim_ylim_rescale(mdl_data)
+    # Calc the sizes of the x and y axes
+    x_size = mdl_data.size.x // mdl_data.pixel_per_point
+    y_size = mdl_data.size.y // mdl_data.pixel_per_point
+    # Generate the main X and y lines
+    x_line = np.linspace(x_min, x_max, x_size, endpoint=False)
+    y_line = np.linspace(
+        y_max, y_min, y_size, endpoint=False
+    )  # y is inverted, as the y starts from positive to negative
+    return mdlbrt.main_loop(x_line, y_line, mdl_data.max_iter, mdl_data.iteration_limit)
+
+
+@lru_cache(maxsize=REQUEST_CACHE_SIZE)
+def _request_counts(
+    size: XYpointInt,
+    zoom_level: float,
+    pixel_per_point: int,
+    central_point: XYpointFloat,
+    max_iter: int,
+    iteration_limit: int,
+) -> MandelData:
+    """
+    Cached counts behind `Mandelbrot.count_data_from_request`, keyed by the (frozen) fields of the
+    request the counts depend on. The arrays are read-only as they are shared between calls.
+    """
+    # The output flags keep their defaults, they do not change the counts
+    data = _request_grid(
+        MandelRequestSchema.model_construct(
+            size=size,
+            zoom_level=zoom_level,
+            pixel_per_point=pixel_per_point,
+            central_point=central_point,
+            max_iter=max_iter,
+            iteration_limit=iteration_limit,
+        )
+    )
+    data.count_grid.flags.writeable = False
+    data.x_line.flags.writeable = False
+    data.y_line.flags.writeable = False
+    return data
+
+
+def _scratch_array(name: str, size: int, dtype) -> np.array:
+    """
+    Returns an uninitialized array of size elements backed by the named scratch buffer of the
+    calling thread, the buffer is only reallocated when a larger one is needed.
+    """
+    buffers = getattr(_scratch, "buffers", None)
+    if buffers is None:
+        buffers = _scratch.buffers = {}
+    key = (name, np.dtype(dtype))
+    buffer = buffers.get(key)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        if size <= SCRATCH_MAX_POINTS:
+            buffers[key] = buffer
+    return buffer[:size]
+
 
 class Mandelbrot:
     """
     A class used to generate and manipulate Mandelbrot sets.
 
     Attributes:
-        `plane_default_limits` (dict): The default limits of the complex plane at zoom 1.
+        `plane_default_limits` (tuple): The default (x_min, x_max, y_min, y_max) limits of the complex
+                                        plane at zoom 1.
 
     Methods:
         `generate_series_c(c: complex, iterations:int)`: Generates a series of complex numbers based
                                                          on the Mandelbrot set algorithm.
-        `xlim_ylim_rescale(mdl_data: MandelRequestSchema) -> dict`: Rescales the x and y limits of the plane
+        `xlim_ylim_rescale(mdl_data: MandelRequestSchema) -> tuple`: Rescales the x and y limits of the plane
                                                              based on the aspect ratio and zoom level.
         `main_loop(mdl_data: MandelRequestSchema) -> np.array`: Perform the main loop to calculate the
                                                          Mandelbrot set.
+        `numpy_loop(x_line, y_line, max_iter, iteration_limit) -> np.array`: NumPy fallback of the
+                                                         numba kernel used by `main_loop`.
     """
 
-    def __init__(self):
-        """
-        Initializes the Mandelbrot set generator.
-        """
-        self.plane_default_limits = (
-            {  # the default limits of the complex plane at zoom 1
-                "x_min": -2.5,
-                "x_max": 2.5,
-                "y_min": -2.5,
-                "y_max": 2.5,
-            }
-        )
+    # The class holds no per instance state, Mandelbrot() is created for every request
+    __slots__ = ()
+
+    # the default (x_min, x_max, y_min, y_max) limits of the complex plane at zoom 1
+    plane_default_limits = (-2.5, 2.5, -2.5, 2.5)
 
     def generate_series_c(self, c: complex, iterations: int):
         """
@@ -49,16 +205,11 @@ class Mandelbrot:
             `iterations` (int): The number of iterations to perform.
 
         Returns:
-            list: A list of complex numbers representing the generated series.
+            np.array: Read-only complex128 array with the generated series (z_1 ... z_iterations).
         """
-        series = []
-        zn = 0
-        for _ in range(iterations):
-            zn = zn**2 + c
-            series.append(zn)
-        return series
+        return _series_c(complex(c), iterations)
 
-    def xlim_ylim_rescale(self, mdl_data: MandelRequestSchema) -> dict:
+    def xlim_ylim_rescale(self, mdl_data: MandelRequestSchema) -> tuple:
         """
         Rescales the x and y limits of the plane based on the aspect ratio and zoom level.
 
@@ -66,39 +217,24 @@ class Mandelbrot:
             `mdl_data` (MandelRequestSchema): An object containing parameters for the Mandelbrot set calculation.
 
         Returns:
-            dict: A dictionary containing the rescaled x and y limits of the plane. The keys are 'x_min',
-                  'x_max', 'y_min', and 'y_max'.
+            tuple: The rescaled (x_min, x_max, y_min, y_max) limits of the plane.
         """
         aspect_ratio = mdl_data.size.x / mdl_data.size.y
-        plane_limits = self.plane_default_limits.copy()
-
-        for key in plane_limits:
-            if key.startswith("x") and aspect_ratio < 1:
-                plane_limits[key] = (
-                    self.plane_default_limits[key] / mdl_data.zoom_level
-                    + mdl_data.central_point.x
-                ) * aspect_ratio
-                continue
-            elif key.startswith("x") and aspect_ratio >= 1:
-                plane_limits[key] = (
-                    self.plane_default_limits[key] / mdl_data.zoom_level
-                    + mdl_data.central_point.x
-                )
-
-                continue
-            elif key.startswith("y") and aspect_ratio > 1:
-                plane_limits[key] = (
-                    self.plane_default_limits[key] / mdl_data.zoom_level
-                    + mdl_data.central_point.y
-                ) / aspect_ratio
-                continue
-            elif key.startswith("y") and aspect_ratio <= 1:
-                plane_limits[key] = (
-                    self.plane_default_limits[key] / mdl_data.zoom_level
-                    + mdl_data.central_point.y
-                )
-                continue
-        return plane_limits
+        x_min, x_max, y_min, y_max = self.plane_default_limits
+        # Half widths of the view, the longer side keeps the default extent
+        half_x = (x_max - x_min) / 2 / mdl_data.zoom_level
+        half_y = (y_max - y_min) / 2 / mdl_data.zoom_level
+        half_x *= min(aspect_ratio, 1.0)
+        half_y /= max(aspect_ratio, 1.0)
+        # Centered on central_point (only the extent depends on the aspect ratio)
+        center_x = (x_max + x_min) / 2 + mdl_data.central_point.x
+        center_y = (y_max + y_min) / 2 + mdl_data.central_point.y
+        return (
+            center_x - half_x,
+            center_x + half_x,
+            center_y - half_y,
+            center_y + half_y,
+        )
 
     def colorize(
         self,
@@ -119,75 +255,437 @@ class Mandelbrot:
                                         Defaults to False.
 
         Returns:
-            If is_canvas is True, returns a flattened list containing the color values for each pixel.
-            If is_canvas is False, returns a dictionary containing the color values for each channel (red, green, blue).
-        """
-        color_max, color_min = 255, 0
-        max_iter_grid = np.full_like(count_grid, max_iter)
-        np_red = count_grid / max_iter_grid * color_max
-        np_green = (np.cos(count_grid) + 1) / 2 * color_max
-        np_blue = (np.sin(count_grid) + 1) / 2 * color_max
+            If is_canvas is True, returns a flat uint8 array with the RGBA values of each pixel.
+            If is_canvas is False, returns a dictionary containing the uint8 color values for each channel (red, green, blue).
+        """
+        # count_grid only holds integers up to max_iter, the colors are gathered from the colormap
+        # instead of evaluating cos/sin on every point (see `color_table` for large max_iter)
+        lut, count_grid = self.color_table(count_grid, max_iter)
         if is_canvas:
-            gamma = color_max
-            np_red = np_red.repeat(pixel_pp, axis=1).astype(int).flatten()
-            np_green = np_green.repeat(pixel_pp, axis=1).astype(int).flatten()
-            np_blue = np_blue.repeat(pixel_pp, axis=1).astype(int).flatten()
-            np_gamma = np.full_like(np_red, gamma)
-            new_arr = np.vstack([np_red, np_green, np_blue, np_gamma])
-            return new_arr.flatten("F").tolist()
+            gamma = 255
+            # RGBA pixels one after the other, as in the canvas ImageData
+            rgba_lut = np.empty((len(lut), 4), dtype=np.uint8)
+            rgba_lut[:, :3] = lut
+            rgba_lut[:, 3] = gamma
+            height, width = count_grid.shape
+            rgba = np.empty((height, width * pixel_pp, 4), dtype=np.uint8)
+            self.gather_colors(rgba_lut, count_grid, pixel_pp, rgba)
+            return rgba.reshape(-1)
         else:
+            # The (1 byte) counts are upsampled to their pixel_pp pixels first, so a single np.take
+            # writes every output byte once
+            if pixel_pp > 1:
+                count_grid = count_grid.repeat(pixel_pp, axis=1)
+            # The channels are gathered as separate (contiguous) uint8 planes
+            planes = np.take(lut.T, count_grid, axis=1)
             colors_dic = {}
-            colors_dic["red"] = np_red.repeat(pixel_pp, axis=1).astype(int)
-            colors_dic["green"] = np_green.repeat(pixel_pp, axis=1).astype(int)
-            colors_dic["blue"] = np_blue.repeat(pixel_pp, axis=1).astype(int)
+            colors_dic["red"] = planes[0]
+            colors_dic["green"] = planes[1]
+            colors_dic["blue"] = planes[2]
             return colors_dic
 
-    def main_loop(
+    def gather_colors(
+        self, lut: np.array, count_grid: np.array, pixel_pp: int, out: np.array
+    ):
+        """
+        Writes the colors of the counts into out, each count repeated on pixel_pp pixels of its row.
+        The rows are processed in strips of about COLOR_STRIP_BYTES of pixels, the counts of a strip
+        are upsampled and gathered while they are still in the cache.
+
+        Args:
+            lut (np.array): (n, channels) uint8 colormap, e.g. from `color_table`.
+            count_grid (np.array): 2D array of indices in lut, e.g. the counts for `color_lut`.
+            pixel_pp (int): The number of pixels per point.
+            out (np.array): (height, width * pixel_pp, channels) uint8 array the pixels are written to.
+        """
+        # The row size comes from the shape, out can have no rows (size.y < pixel_per_point)
+        row_bytes = int(np.prod(out.shape[1:])) * out.itemsize
+        strip_rows = max(1, COLOR_STRIP_BYTES // max(row_bytes, 1))
+        for row_start in range(0, len(count_grid), strip_rows):
+            row_end = row_start + strip_rows
+            counts = count_grid[row_start:row_end]
+            if pixel_pp > 1:
+                counts = counts.repeat(pixel_pp, axis=1)
+            # The indices are always valid, mode="clip" skips the bounds check that
+            # also makes np.take gather into a temporary copy of out
+            np.take(lut, counts, axis=0, out=out[row_start:row_end], mode="clip")
+
+    def color_lut(self, max_iter: int) -> np.array:
+        """
+        Returns the colormap of `colorize` as a lookup table, the colors only depend on the count so
+        `color_lut(max_iter)[count_grid]` gives the (H, W, 3) RGB image in a single gather.
+
+        Args:
+            max_iter (int): The maximum number of iterations the counts were calculated with.
+
+        Returns:
+            np.array: Read-only (max_iter + 1, 3) uint8 array with the RGB color of each count.
+
+        Raises:
+            ValueError: If max_iter + 1 is above COLOR_LUT_MAX_ROWS, use `color_table` instead.
+        """
+        if max_iter + 1 > COLOR_LUT_MAX_ROWS:
+            raise ValueError(
+                f"max_iter {max_iter} is too large for a color table, use color_table"
+            )
+        return _color_lut(max_iter)
+
+    def color_table(self, count_grid: np.array, max_iter: int) -> tuple:
+        """
+        Returns a colormap and the indices of the counts in it, `lut[indices]` gives the RGB colors
+        of count_grid. Up to COLOR_LUT_MAX_ROWS counts (or when the grid has more points than
+        max_iter) this is the cached `color_lut` and count_grid itself. Above it only the colors of
+        the counts present in the grid are calculated, so the memory scales with the grid and not
+        with max_iter.
+
+        Args:
+            count_grid (np.array): 2D array of counts, none of them above max_iter.
+            max_iter (int): The maximum number of iterations the counts were calculated with.
+
+        Returns:
+            tuple: (lut, indices), the (n, 3) uint8 colormap and the indices (shape of count_grid).
+        """
+        if max_iter + 1 <= min(COLOR_LUT_MAX_ROWS, max(count_grid.size, 256)):
+            return self.color_lut(max_iter), count_grid
+        unique_counts, indices = np.unique(count_grid, return_inverse=True)
+        return _count_colors(unique_counts, max_iter), indices.reshape(count_grid.shape)
+
+    def count_dtype(self, max_iter: int):
+        """
+        Returns the smallest unsigned integer dtype able to hold counts up to max_iter.
+        """
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if max_iter <= np.iinfo(dtype).max:
+                return dtype
+        return np.uint64
+
+    def plane_dtype(self, x_line: np.array, y_line: np.array, iteration_limit: int):
+        """
+        Picks the float dtype used to iterate the grid. float32 halves the memory traffic and doubles
+        the SIMD lanes, but is only precise enough while the grid spacing stays well above the
+        float32 resolution of the coordinates (i.e. for zoomed out views).
+
+        Args:
+            x_line (np.array): Array of x-coordinates for the complex grid.
+            y_line (np.array): Array of y-coordinates for the complex grid.
+            iteration_limit (int): Limit for the absolute value of the complex numbers.
+
+        Returns:
+            np.float32 or np.float64
+        """
+        if len(x_line) < 2 or len(y_line) < 2:
+            return np.float64
+        step = min(abs(x_line[1] - x_line[0]), abs(y_line[1] - y_line[0]))
+        scale = max(
+            abs(x_line[0]),
+            abs(x_line[-1]),
+            abs(y_line[0]),
+            abs(y_line[-1]),
+            iteration_limit,
+        )
+        if step >= FLOAT32_MIN_ULPS * np.finfo(np.float32).eps * scale:
+            return np.float32
+        return np.float64
+
+    def in_main_bulbs(self, x: np.array, y: np.array) -> np.array:
+        """
+        Closed-form test for the main cardioid and the period-2 bulb, the points inside them
+        never escape so they do not need to be iterated.
+
+        Args:
+            x (np.array): The real parts of the points.
+            y (np.array): The imaginary parts of the points.
+
+        Returns:
+            np.array: Boolean array, True for the points inside the cardioid or the bulb.
+        """
+        x_shift = x - 0.25
+        y_sq = y * y
+        q = x_shift * x_shift + y_sq
+        in_cardioid = q * (q + x_shift) < 0.25 * y_sq
+        in_bulb = (x + 1.0) * (x + 1.0) + y_sq < 0.0625
+        return in_cardioid | in_bulb
+
+    def numpy_loop(
         self, x_line: np.array, y_line: np.array, max_iter: int, iteration_limit: int
+    ) -> np.array:
+        """
+        Calculates the escape counts with NumPy, used when numba is not available.
+
+        Args:
+            x_line (np.array): Array of x-coordinates for the complex grid.
+            y_line (np.array): Array of y-coordinates for the complex grid.
+            max_iter (int): Maximum number of iterations.
+            iteration_limit (int): Limit for the absolute value of the complex numbers.
+
+        Returns:
+            np.array: 2D array with the number of iterations before each point escaped.
+        """
+        # The real and imaginary parts are kept as separate planes (no complex grid), in the dtype
+        # of the lines. They are broadcast views of the lines, nothing is allocated for them
+        shape = (len(y_line), len(x_line))
+        c_real = np.broadcast_to(x_line, shape)
+        c_imag = np.broadcast_to(y_line[:, None], shape)
+        # |z| > limit  <=>  zr^2 + zi^2 > limit^2
+        limit_sq = c_real.dtype.type(iteration_limit) ** 2
+
+        # Points that never escape keep max_iter, escaped ones get the iteration they escaped at
+        count_grid = np.full(shape, max_iter, dtype=self.count_dtype(max_iter))
+        count_flat = count_grid.reshape(-1)  # View used to write back the escape counts
+
+        # Only the points that have not escaped yet are iterated (compacted 1D arrays)
+        if iteration_limit >= 2:
+            # The main cardioid and period-2 bulb never escape, they keep max_iter
+            outside = ~self.in_main_bulbs(c_real, c_imag)
+            active_idx = np.flatnonzero(outside)
+            cr, ci = c_real[outside], c_imag[outside]
+        else:
+            active_idx = np.arange(count_grid.size)
+            cr, ci = c_real.flatten(), c_imag.flatten()
+        # The iteration arrays are taken from the scratch buffers reused between calls
+        zr = _scratch_array("zr", cr.size, cr.dtype)
+        zi = _scratch_array("zi", cr.size, cr.dtype)
+        # The squares are reused by the escape test and the next step
+        zr_sq = _scratch_array("zr_sq", cr.size, cr.dtype)
+        zi_sq = _scratch_array("zi_sq", cr.size, cr.dtype)
+        for array in (zr, zi, zr_sq, zi_sq):
+            array.fill(0)
+        # Scratch buffers of the escape test, sliced to the number of active points
+        mod_sq_buffer = _scratch_array("mod_sq", cr.size, cr.dtype)
+        escaped_buffer = _scratch_array("escaped", cr.size, bool)
+        # Escaped points not yet removed from the active arrays
+        frozen_buffer = _scratch_array("frozen", cr.size, bool)
+        frozen = frozen_buffer
+        frozen.fill(False)
+        n_frozen = 0
+        # Checkpoints of the periodicity check, moved at doubling intervals (Brent)
+        saved_zr = _scratch_array("saved_zr", cr.size, cr.dtype)
+        saved_zi = _scratch_array("saved_zi", cr.size, cr.dtype)
+        saved_zr.fill(0)
+        saved_zi.fill(0)
+        save_at = PERIOD_CHECK
+
+        # The main loop, every step is written in place so no temporaries are allocated
+        for i in range(max_iter):
+            # zi = 2 * zr * zi + ci
+            np.multiply(zr, zi, out=zi)
+            zi += zi
+            zi += ci
+            # zr = zr^2 - zi^2 + cr
+            np.subtract(zr_sq, zi_sq, out=zr)
+            zr += cr
+            np.multiply(zr, zr, out=zr_sq)
+            np.multiply(zi, zi, out=zi_sq)
+            mod_sq = mod_sq_buffer[: zr.size]
+            np.add(zr_sq, zi_sq, out=mod_sq)
+            escaped = np.greater(mod_sq, limit_sq, out=escaped_buffer[: zr.size])
+            done_idx = np.flatnonzero(escaped)
+            count_flat[active_idx[done_idx]] = i
+            if i % PERIOD_CHECK == 0 and i > 0:
+                # The points back at their checkpoint are done as well, they keep max_iter
+                periodic = (zr == saved_zr) & (zi == saved_zi) & ~frozen
+                done_idx = np.concatenate((done_idx, np.flatnonzero(periodic)))
+                if i == save_at:
+                    np.copyto(saved_zr, zr)
+                    np.copyto(saved_zi, zi)
+                    save_at += save_at
+            if done_idx.size:
+                # Done points are frozen at z = c = 0 (which never escapes) instead of being
+                # removed right away, the arrays are only compacted once enough of them are done
+                for array in (cr, ci, zr, zi, zr_sq, zi_sq):
+                    array[done_idx] = 0
+                frozen[done_idx] = True
+                n_frozen += done_idx.size
+                # Every point escaped, nothing left to iterate
+                if n_frozen == active_idx.size:
+                    break
+                if n_frozen * COMPACT_FRACTION >= active_idx.size:
+                    still_active = ~frozen
+                    active_idx = active_idx[still_active]
+                    cr, ci = cr[still_active], ci[still_active]
+                    zr, zi = zr[still_active], zi[still_active]
+                    zr_sq, zi_sq = zr_sq[still_active], zi_sq[still_active]
+                    saved_zr = saved_zr[still_active]
+                    saved_zi = saved_zi[still_active]
+                    frozen = frozen_buffer[: active_idx.size]
+                    frozen.fill(False)
+                    n_frozen = 0
+
+        return count_grid
+
+    def mirror_rows(self, y_line: np.array):
+        """
+        Finds the rows of an evenly spaced y_line that are the mirror image (about the real axis)
+        of other rows, the Mandelbrot set is symmetric so those rows do not need to be calculated.
+        With y_i = y_0 + i * step the rows i and j mirror each other when i + j = -2 * y_0 / step.
+        The rows of a linspace are only mirror images up to rounding (y_j can differ from -y_i by
+        an ulp), so the copied counts are an approximation on the boundary of the set: a few points
+        per million get the count of the exactly mirrored point instead of their own.
+
+        Args:
+            y_line (np.array): Array of y-coordinates for the complex grid.
+
+        Returns:
+            tuple: (computed_rows, mirrored_rows, source_rows) index arrays, where each mirrored row
+                   is a copy of the computed source row at the same position. None if the grid has
+                   no mirrored rows.
+        """
+        y_line = np.asarray(y_line, dtype=np.float64)
+        n_rows = len(y_line)
+        if n_rows < 3:
+            return None
+        step = (y_line[-1] - y_line[0]) / (n_rows - 1)
+        if step == 0 or not np.allclose(np.diff(y_line), step, rtol=1e-6, atol=0):
+            return None  # Not evenly spaced
+        pair_sum = -2 * y_line[0] / step
+        if abs(pair_sum - round(pair_sum)) > 1e-6:
+            return None  # The real axis does not fall on (or halfway between) rows
+        pair_sum = round(pair_sum)
+
+        rows = np.arange(n_rows)
+        source_rows = pair_sum - rows
+        mirrored = (2 * rows > pair_sum) & (source_rows >= 0) & (source_rows < n_rows)
+        if not mirrored.any():
+            return None
+        return rows[~mirrored], rows[mirrored], source_rows[mirrored]
+
+    def select_backend(self, backend: str, n_points: int) -> str:
+        """
+        Resolves the backend used by `main_loop` to calculate the counts.
+
+        Args:
+            backend (str): "cuda", "numba", "numpy" or "auto". With "auto" grids of more than
+                           CUDA_MIN_POINTS points go to the GPU when a CUDA device is available,
+                           the others to the numba kernel (the NumPy loop without numba).
+            n_points (int): The number of points to calculate.
+
+        Returns:
+            str: "cuda", "numba" or "numpy".
+        """
+        numba_available = mandel_kernel is not None
+        gpu_available = mandel_cuda is not None and cuda_available()
+        if backend == "auto":
+            if gpu_available and n_points > CUDA_MIN_POINTS:
+                return "cuda"
+            return "numba" if numba_available else "numpy"
+        available = {"cuda": gpu_available, "numba": numba_available, "numpy": True}
+        if backend not in available:
+            raise ValueError(f"Unknown backend {backend!r}")
+        if not available[backend]:
+            raise ValueError(f"The {backend} backend is not available")
+        return backend
+
+    def main_loop(
+        self,
+        x_line: np.array,
+        y_line: np.array,
+        max_iter: int,
+        iteration_limit: int,
+        backend: str = "auto",
+        dtype=None,
     ) -> MandelData:
         """
         Perform the main loop of the Mandelbrot algorithm.
+        Large grids run on the GPU (`src.mandel_cuda`) when a CUDA device is available, otherwise
+        the numba kernel from `src.mandel_kernel` is used, and `numpy_loop` without numba.
+        For grids symmetric about the real axis only one half is calculated and the other half is
+        copied from it, which can differ on a few boundary points (see `mirror_rows`).
 
         Args:
             x_line (np.array): Array of x-coordinates for the complex grid.
             y_line (np.array): Array of y-coordinates for the complex grid.
             max_iter (int): Maximum number of iterations.
             iteration_limit (int): Limit for the absolute value of the complex numbers.
+            backend (str, optional): Forces the "cuda", "numba" or "numpy" backend (see
+                                     `select_backend`). Defaults to "auto".
+            dtype (optional): np.float32 or np.float64 to force the precision of the iteration,
+                              by default it is picked from the grid spacing (see `plane_dtype`).
 
         Returns:
             MandelData: Object containing the results of the Mandelbrot algorithm.
         """
+        # The coordinates are unboxed into plain float arrays once, nothing below uses complex values
+        x_line = np.asarray(x_line, dtype=np.float64)
+        y_line = np.asarray(y_line, dtype=np.float64)
+        if dtype is None:
+            float_dtype = self.plane_dtype(x_line, y_line, iteration_limit)
+        elif np.dtype(dtype) in (np.float32, np.float64):
+            float_dtype = np.dtype(dtype).type
+        else:
+            raise ValueError(
+                f"Unsupported dtype {np.dtype(dtype)}, use float32 or float64"
+            )
+        cr = np.ascontiguousarray(x_line, dtype=float_dtype)
+        ci = np.ascontiguousarray(y_line, dtype=float_dtype)
+
+        # When the grid is symmetric about the real axis only one half is calculated, the copied
+        # rows are within rounding of the rows they stand for
+        mirror = self.mirror_rows(y_line)
+        if mirror is not None:
+            computed_rows, mirrored_rows, source_rows = mirror
+            ci = ci[computed_rows]
+
+        limit_sq = float_dtype(iteration_limit) ** 2
+        backend = self.select_backend(backend, len(cr) * len(ci))
+        if backend == "cuda":
+            count_grid = np.empty((len(ci), len(cr)), dtype=self.count_dtype(max_iter))
+            mandel_cuda(cr, ci, max_iter, limit_sq, count_grid)
+        elif backend == "numba":
+            count_grid = np.empty((len(ci), len(cr)), dtype=self.count_dtype(max_iter))
+            if KERNEL_THREADSAFE:
+                mandel_kernel(cr, ci, max_iter, limit_sq, count_grid)
+            else:
+                with kernel_lock:
+                    mandel_kernel(cr, ci, max_iter, limit_sq, count_grid)
+        else:
+            count_grid = self.numpy_loop(cr, ci, max_iter, iteration_limit)
 
-        complex_grid = np.zeros(
-            (len(y_line), len(x_line)), dtype=complex
-        )  # Create an empty complex grid
-        x_real, y_imag = np.meshgrid(
-            x_line, y_line
-        )  # Create the meshgrid in order to fill in the complex grid
-        complex_grid.real = x_real
-        complex_grid.imag = y_imag
-
-        mask_grid = np.ones_like(
-            complex_grid, dtype=bool
-        )  # Create a mask grid of the complex plane to follow which elements to do the calculations
-        count_grid = np.zeros_like(
-            complex_grid, dtype=int
-        )  # Keeps count of the operations
-        z_grid = np.zeros_like(
-            complex_grid
-        )  # Z Grid to keep the values of the complex numbers
-
-        # The main loop
-        for _ in range(max_iter):
-            z_grid[mask_grid] = np.power(z_grid[mask_grid], 2) + complex_grid[mask_grid]
-            mask_grid = np.logical_and(mask_grid, np.abs(z_grid) <= iteration_limit)
-            count_grid += mask_grid
+        if mirror is not None:
+            half_grid = count_grid
+            count_grid = np.empty((len(y_line), len(cr)), dtype=half_grid.dtype)
+            count_grid[computed_rows] = half_grid
+            count_grid[mirrored_rows] = count_grid[source_rows]
 
         data = MandelData(
-            x_line=x_line, y_line=y_line, count_grid=count_grid, color_data=None
+            x_line=x_line,
+            y_line=y_line,
+            count_grid=count_grid,
+            color_data=None,
+            max_iter=max_iter,
         )
         return data
 
+    def count_data_from_request(self, mdl_data: MandelRequestSchema) -> MandelData:
+        """
+        Calculates the counts for the provided MandelRequestSchema, without the color data.
+        The counts of the last REQUEST_CACHE_SIZE grids of up to REQUEST_CACHE_MAX_BYTES are cached,
+        the arrays of a cached result are read-only.
+
+        Args:
+            mdl_data (MandelRequestSchema): The MandelRequestSchema object containing the parameters for generating Mandelbrot data.
+
+        Returns:
+            MandelData: The MandelData object with the count_grid and the lines, color_data is None.
+        """
+        n_points = (mdl_data.size.x // mdl_data.pixel_per_point) * (
+            mdl_data.size.y // mdl_data.pixel_per_point
+        )
+        grid_bytes = n_points * np.dtype(self.count_dtype(mdl_data.max_iter)).itemsize
+        if grid_bytes > REQUEST_CACHE_MAX_BYTES:
+            return _request_grid(mdl_data)
+        # The cached arrays are shared (read-only), the container is copied so the callers can
+        # set their own color_data
+        return replace(
+            _request_counts(
+                mdl_data.size,
+                mdl_data.zoom_level,
+                mdl_data.pixel_per_point,
+                mdl_data.central_point,
+                mdl_data.max_iter,
+                mdl_data.iteration_limit,
+            )
+        )
+
     def mandel_data_from_request(self, mdl_data: MandelRequestSchema):
         """
         Generate Mandelbrot data based on the provided MandelRequestSchema.
@@ -198,22 +696,9 @@ class Mandelbrot:
 
         Returns:
             MandelData: The generated MandelData object containing the Mandelbrot data.
-            The returned object is in np.arrays format, needs to be transformed to lists in order to return to backend.
-        """
-        plane_limits = self.xlim_ylim_rescale(mdl_data)
-        # Calc the sizes of the x and y axes
-        x_size = mdl_data.size.x // mdl_data.pixel_per_point
-        y_size = mdl_data.size.y // mdl_data.pixel_per_point
-        # Generate the main X and y lines
-        x_line = np.linspace(
-            plane_limits["x_min"], plane_limits["x_max"], x_size, endpoint=False
-        )
-        y_line = np.linspace(
-            plane_limits["y_max"], plane_limits["y_min"], y_size, endpoint=False
-        )  # y is inverted, as the y starts from positive to negative
-        data = self.main_loop(
-            x_line, y_line, mdl_data.max_iter, mdl_data.iteration_limit
-        )
+            The returned object is in np.arrays format (uint8 colors), the API serializes them directly with orjson.
+        """
+        data = self.count_data_from_request(mdl_data)
         data.color_data = self.colorize(
             data.count_grid,
             mdl_data.max_iter,
@@ -1,18 +1,26 @@
-from pydantic import BaseModel
+from dataclasses import dataclass
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, Any
 
 
+# The request models are frozen, so they are hashable and can be used as cache keys
 class XYpointInt(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     x: int
     y: int
 
 
 class XYpointFloat(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     x: float
     y: float
 
 
 class MandelRequestSchema(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     size: XYpointInt
     zoom_level: float
     pixel_per_point: int
@@ -20,6 +28,7 @@ class MandelRequestSchema(BaseModel):
     max_iter: int = 255
     iteration_limit: int = 2
     is_canvas: Optional[bool] = False # if sent to true the color is returned in canvas format
+    is_base64: Optional[bool] = False # if sent to true the arrays are returned as base64 encoded raw bytes
 
 class MandelLineSpaceSchema(BaseModel):
     x_line: Any
@@ -27,11 +36,15 @@ class MandelLineSpaceSchema(BaseModel):
     max_iter: int = 255
     iteration_limit: int = 2
 
-class MandelData(BaseModel):
+# Internal result container (never validated or sent as is), a plain dataclass avoids the
+# pydantic model overhead when the large arrays are stored in it
+@dataclass(slots=True)
+class MandelData:
     count_grid: Any
     x_line: Any
     y_line: Any
     color_data: Any
     level: str = 'na'
+    max_iter: int = 255 # the max_iter the count_grid was calculated with (needed for the colors)
 
 
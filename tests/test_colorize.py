@@ -0,0 +1,52 @@
+import tracemalloc
+import unittest
+
+import numpy as np
+
+from src.mandelbrot import Mandelbrot, _color_lut
+
+
+class TestColorizeLargeMaxIter(unittest.TestCase):
+    def setUp(self):
+        self.max_iter = 10**9
+        self.count_grid = np.array([[0, 1], [12345, self.max_iter]], dtype=np.uint32)
+
+    def expected_rgb(self):
+        counts = self.count_grid.astype(np.float64)
+        rgb = np.empty(counts.shape + (3,), dtype=np.uint8)
+        rgb[..., 0] = counts / self.max_iter * 255
+        rgb[..., 1] = (np.cos(counts) + 1) / 2 * 255
+        rgb[..., 2] = (np.sin(counts) + 1) / 2 * 255
+        return rgb
+
+    def test_tiny_grid_does_not_build_a_table_of_max_iter_rows(self):
+        cached_tables = _color_lut.cache_info().currsize
+        tracemalloc.start()
+        try:
+            colors = Mandelbrot().colorize(self.count_grid, self.max_iter)
+            canvas = Mandelbrot().colorize(
+                self.count_grid, self.max_iter, pixel_pp=2, is_canvas=True
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # A table of max_iter rows would be 3 GB, the colors of 4 counts need a few KB
+        self.assertLess(peak, 1 << 20)
+        self.assertEqual(_color_lut.cache_info().currsize, cached_tables)
+
+        expected = self.expected_rgb()
+        np.testing.assert_array_equal(colors["red"], expected[..., 0])
+        np.testing.assert_array_equal(colors["green"], expected[..., 1])
+        np.testing.assert_array_equal(colors["blue"], expected[..., 2])
+        rgba = canvas.reshape(2, 4, 4)
+        np.testing.assert_array_equal(rgba[..., :3], expected.repeat(2, axis=1))
+        np.testing.assert_array_equal(rgba[..., 3], 255)
+
+    def test_color_lut_refuses_large_max_iter(self):
+        with self.assertRaises(ValueError):
+            Mandelbrot().color_lut(self.max_iter)
+
+
+if __name__ == "__main__":
+    unittest.main()